@@ -0,0 +1,27 @@
+# gunicorn -c gunicorn_conf.py main:app
+import os
+
+bind = os.getenv("BIND", "0.0.0.0:5000")
+
+# Import main.py (paddle, PyMuPDF, Flask app) once in the master and share it
+# copy-on-write with the workers. Each worker starts its own OCR process pool
+# after the fork (see post_fork), so the pool is never forked from the master.
+preload_app = True
+
+# Each worker owns an OCR pool of min(cores, 4) processes, and every pool process
+# loads its own PaddleOCR model - that's WEB_CONCURRENCY x min(cores, 4) model
+# copies in memory (4 with the defaults on a 4+ core box). One worker already
+# keeps up to 4 cores busy through its pool; threads cover concurrent uploads and
+# LLM waits. main.py reads the same WEB_CONCURRENCY to split cores between all
+# OCR processes, so set it in the environment rather than editing this file.
+workers = int(os.getenv("WEB_CONCURRENCY", "1"))
+worker_class = "gthread"
+threads = 4
+
+timeout = 120  # OCR of a multi-page scan can run past the 30s default
+
+
+def post_fork(server, worker):
+    # Load and warm the OCR models before this worker takes its first request
+    import main
+    main.warm_ocr_pool()
@@ -2,98 +2,374 @@
 # llama-3.1-8b-instant
 import os
 import json
+import logging
+import asyncio
 import re
+import math
+import hashlib
+import uuid
+import sqlite3
+from contextlib import closing
+import threading
+import multiprocessing
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from flask import Flask, render_template, request, jsonify
 from werkzeug.utils import secure_filename
+from werkzeug.exceptions import RequestEntityTooLarge
+from streaming_form_data import StreamingFormDataParser
+from streaming_form_data.targets import FileTarget
+import paddle
 from paddleocr import PaddleOCR
-from groq import Groq
+from groq import AsyncGroq
 import fitz  # PyMuPDF
-from PIL import Image
 import numpy as np
+import orjson
 
 from dotenv import load_dotenv
 load_dotenv()
 
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+logging.basicConfig(format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+logger = logging.getLogger(__name__)
+logger.setLevel(LOG_LEVEL)
 
 # ---------------- CONFIG ----------------
 UPLOAD_FOLDER = "uploads"
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
+MAX_UPLOAD_BYTES = 50 * 1024 * 1024
+UPLOAD_CHUNK_SIZE = 64 * 1024
 
 GROQ_API_KEY = os.getenv("GROQ_API_KEY")  # <-- put your key here
+
+MIN_NATIVE_CHARS = int(os.getenv("MIN_NATIVE_CHARS", "50"))  # below this a page's text layer is treated as missing
+OCR_MAX_ZOOM = float(os.getenv("OCR_ZOOM", "2.5"))  # upper bound on the render zoom for OCR (1.0 = 72 DPI)
+MAX_OCR_CHARS = int(os.getenv("MAX_OCR_CHARS", "6000"))  # past this, interior pages are skipped
+OCR_TARGET_SIDE = 1600  # rendered long side in pixels; detection downscales to 960 on CPU, recognition crops keep it
+OCR_WORKERS = min(os.cpu_count() or 1, 4)
+# gunicorn web workers, each with its own OCR pool - must match gunicorn_conf.py
+WEB_WORKERS = int(os.getenv("WEB_CONCURRENCY", "1"))
+OCR_TEXTLINE_ORIENTATION = os.getenv("OCR_TEXTLINE_ORIENTATION", "1") == "1"  # fix rotated/upside-down lines
+REC_BATCH_NUM = int(os.getenv("REC_BATCH_NUM", "1"))  # recognition batch size on CPU
+OCR_ENABLE_HPI = os.getenv("OCR_ENABLE_HPI", "0") == "1"  # ONNX Runtime/OpenVINO backend, needs its extra deps
+OCR_BATCH_PAGES = 4  # max pages sent to PaddleOCR in a single call
+OCR_MAX_PENDING = OCR_WORKERS * 2  # OCR batches allowed to be queued at once
+SPECULATIVE_MIN_CHARS = 500  # text needed before the LLM call starts while later pages OCR
+SPECULATIVE_WAIT = 0.2  # seconds the next page may take before the LLM call starts without it
+SHORTLIST_EDGE_LINES = 20  # lines always kept from the top and bottom of the text
+SHORTLIST_MIN_CHARS = 200  # below this the shortlist is considered too thin to use
+LLM_CACHE_SIZE = 256  # extractions remembered per process, keyed on the exact text
+CACHE_DB = os.getenv("CACHE_DB", "invoice_cache.sqlite3")  # per-file OCR text + results
+CACHE_MAX_ROWS = int(os.getenv("CACHE_MAX_ROWS", "1000"))  # files kept, least recently written dropped first
 # ----------------------------------------
 
 app = Flask(__name__)
 app.config["UPLOAD_FOLDER"] = UPLOAD_FOLDER
+app.config["MAX_CONTENT_LENGTH"] = MAX_UPLOAD_BYTES
 
-# Initialize OCR ONCE
-ocr = PaddleOCR(use_textline_orientation=True, lang="en")
+# OCR runs in a process pool; each worker initializes its own PaddleOCR ONCE
+ocr = None
+_ocr_pool = None
+_ocr_pool_lock = threading.Lock()
 
-# Initialize Groq client
-groq_client = Groq(api_key=GROQ_API_KEY)
+# sha256(text) -> parsed invoice JSON, oldest entries evicted first
+_llm_cache = {}
 
 
 # ---------- OCR ----------
-def extract_text_from_pdf(pdf_path):
+def _init_ocr_worker():
     """
-    Extract text from PDF - first try native text extraction, then OCR if needed
+    Pool initializer - load the model inside the worker instead of pickling it
     """
+    global ocr
+    options = {"use_textline_orientation": OCR_TEXTLINE_ORIENTATION, "lang": "en"}
+    if not paddle.is_compiled_with_cuda():
+        # Split the cores between every OCR process on the host (web workers x pool
+        # workers) instead of each one using all of them
+        options["cpu_threads"] = max(1, (os.cpu_count() or 1) // (OCR_WORKERS * WEB_WORKERS))
+        # On CPU batches run line by line anyway, while Paddle's memory arena
+        # grows with batch size - batch size 1 cuts peak memory by ~80%
+        options.update(
+            text_recognition_batch_size=REC_BATCH_NUM,
+            textline_orientation_batch_size=REC_BATCH_NUM,
+            text_det_limit_side_len=960,
+            text_det_limit_type="max",  # 3.x defaults to "min", which upscales small images
+        )
+
+    ocr = None
+    if OCR_ENABLE_HPI:
+        # High-performance inference picks the fastest backend (ONNX Runtime/OpenVINO on CPU)
+        # and needs the extra deps from `paddleocr install_hpi_deps cpu`
+        try:
+            ocr = PaddleOCR(enable_hpi=True, **options)
+        except Exception as e:
+            logger.warning("⚠️ High-performance OCR backend unavailable (%s), using Paddle inference", e)
+    if ocr is None:
+        ocr = PaddleOCR(**options)
+
+    # Warm up with a dummy batch so the first real batch doesn't pay graph setup.
+    # A failed warmup must not kill the worker - the real call will surface the error.
     try:
-        print(f"📄 Opening PDF with PyMuPDF...")
-        pdf_document = fitz.open(pdf_path)
-        extracted_text = ""
+        ocr.predict([np.zeros((640, 480, 3), np.uint8)] * OCR_BATCH_PAGES)
+    except Exception:
+        logger.warning("⚠️ OCR warmup failed", exc_info=True)
 
-        print(f"📄 PDF has {len(pdf_document)} page(s)")
 
-        for page_num in range(len(pdf_document)):
-            print(f"📄 Processing page {page_num + 1}/{len(pdf_document)}")
-            page = pdf_document[page_num]
+def _ocr_ready():
+    return True
 
-            # First, try extracting native text
-            native_text = page.get_text()
 
-            if native_text and len(native_text.strip()) > 50:
-                # PDF has text layer, use it directly
-                print(f"  ✅ Using native text extraction")
-                extracted_text += native_text + "\n"
-            else:
-                # No text layer, use OCR
-                print(f"  🔍 No text layer found, using OCR...")
+def warm_ocr_pool():
+    """
+    Start every OCR worker now (model load + warmup) instead of on the first upload.
+    Call after forking - from gunicorn's post_fork hook or the dev server process.
+    """
+    pool = _get_ocr_pool()
+    for _ in range(OCR_WORKERS):
+        pool.submit(_ocr_ready)
 
-                # Convert page to image
-                mat = fitz.Matrix(2.0, 2.0)  # 2x zoom
-                pix = page.get_pixmap(matrix=mat)
-                img = Image.frombytes("RGB", [pix.width, pix.height], pix.samples)
-                img_array = np.array(img)
 
-                # Run OCR
-                result = ocr.ocr(img_array)
+def _get_ocr_pool():
+    global _ocr_pool
+    with _ocr_pool_lock:
+        if _ocr_pool is None:
+            _ocr_pool = ProcessPoolExecutor(
+                max_workers=OCR_WORKERS,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=_init_ocr_worker,
+            )
+        return _ocr_pool
 
-                if result and len(result) > 0 and result[0]:
-                    for line in result[0]:
-                        if line and len(line) >= 2:
-                            text = line[1][0] if isinstance(line[1], (list, tuple)) else str(line[1])
-                            extracted_text += text + " "
-                            print(f"  📝 {text}")
 
-        pdf_document.close()
+def _discard_ocr_pool(broken_pool):
+    """
+    Drop a pool that lost a worker (OOM, segfault, failed model load) so the next
+    request builds a fresh one instead of failing with BrokenProcessPool forever
+    """
+    global _ocr_pool
+    with _ocr_pool_lock:
+        if _ocr_pool is broken_pool:
+            _ocr_pool = None
+    broken_pool.shutdown(wait=False, cancel_futures=True)
+
 
-        final_text = extracted_text.strip()
-        print(f"\n✅ Total extracted text length: {len(final_text)} characters")
-        print(f"📄 First 500 chars:\n{final_text[:500]}\n")
+def _page_array(img_bytes, width, height, channels):
+    """
+    View the pixmap samples as an HxWxC array without copying them through PIL
+    """
+    img_array = np.frombuffer(img_bytes, dtype=np.uint8).reshape(height, width, channels)
+    if channels == 4:
+        img_array = img_array[:, :, :3]  # drop alpha
+    return img_array
 
-        return final_text
 
-    except Exception as e:
-        print(f"❌ OCR Error: {e}")
-        import traceback
-        traceback.print_exc()
+def _result_lines(result):
+    """
+    Recognized text lines from one page's PaddleOCR 3.x result (dict-like, "rec_texts")
+    """
+    if not result:
+        return []
+    return list(result.get("rec_texts") or [])
+
+
+def _ocr_pages(batch):
+    """
+    Run OCR on a batch of rendered pages (pixel bytes, width, height, channels)
+    in a single PaddleOCR call - executed in a pool worker. Returns one string per page.
+    """
+    imgs = [_page_array(*item) for item in batch]
+
+    # Run OCR - predict() takes a list of images and returns one result per image
+    results = ocr.predict(imgs)
+
+    log_lines = logger.isEnabledFor(logging.DEBUG)
+    texts = []
+    for result in results:
+        parts = _result_lines(result)
+        if log_lines:
+            for text in parts:
+                logger.debug("  📝 %s", text)
+        # One recognized line per text line, so the LLM shortlist can filter them
+        texts.append("\n".join(parts) + "\n")
+
+    return texts
+
+
+def _submit_ocr_batch(pool, batch, pages):
+    """
+    Send queued (page_index, img_bytes, width, height, channels) items to the pool and
+    point each page's slot at (future, position in batch)
+    """
+    future = pool.submit(_ocr_pages, [item[1:] for item in batch])
+    for position, item in enumerate(batch):
+        pages[item[0]] = (future, position)
+    return future
+
+
+def _page_text(entry):
+    """
+    Text for a page slot - native text as-is, or the (blocking) OCR result
+    """
+    if isinstance(entry, str):
+        return entry
+    future, position = entry
+    return future.result()[position]
+
+
+def _page_ready(entry):
+    return entry is not None and (isinstance(entry, str) or entry[0].done())
+
+
+def _known_text(pages):
+    """
+    (characters, page count) of text already in hand - native pages and finished OCR
+    """
+    chars = known = 0
+    for entry in pages:
+        if _page_ready(entry):
+            chars += len(_page_text(entry))
+            known += 1
+    return chars, known
+
+
+def _page_zoom(page):
+    """
+    Render zoom that puts the page's long side at ~OCR_TARGET_SIDE pixels,
+    so small receipts get more detail and large pages don't waste pixels
+    """
+    return min(OCR_MAX_ZOOM, OCR_TARGET_SIDE / max(page.rect.width, page.rect.height))
+
+
+def _native_text(page):
+    """
+    Read the page's text layer block by block, in reading order (top-left to bottom-right)
+    """
+    blocks = page.get_text("blocks", sort=True)
+    # block = (x0, y0, x1, y1, text, block_no, block_type); type 1 is an image block
+    return "\n".join(block[4].strip() for block in blocks if block[6] == 0)
+
+
+def extract_text_from_pdf(pdf_path):
+    """
+    Extract text from PDF - first try native text extraction, then OCR if needed.
+    Pages are rendered here one at a time, OCR runs in parallel in the worker pool.
+    Yields each page's text in page order as soon as it is available.
+    """
+    try:
+        logger.info("📄 Opening PDF with PyMuPDF: %s", pdf_path)
+        # Closed as soon as rendering is done, even if the consumer stops early
+        with fitz.open(pdf_path) as pdf_document:
+            pool = _get_ocr_pool()
+            page_count = len(pdf_document)
+            # Batch OCR pages, but keep batches small enough to spread over all workers
+            batch_size = max(1, min(OCR_BATCH_PAGES, math.ceil(page_count / OCR_WORKERS)))
+            pages = [None] * page_count  # native text, or (future, position) for OCR pages
+            batch = []
+            pending = deque()
+            next_page = 0  # next page to yield
+            skipped = 0
+
+            logger.info("📄 PDF has %d page(s)", page_count)
+
+            for page_num in range(page_count):
+                # Header fields sit on the first pages and totals on the last one -
+                # with enough text already, skip interior pages but still read the last
+                while 0 < page_num < page_count - 1:
+                    known_chars, known_pages = _known_text(pages[:page_num])
+                    if known_chars >= MAX_OCR_CHARS:
+                        break
+                    outstanding = page_num - known_pages  # OCR pages queued or in flight
+                    if not outstanding:
+                        break
+                    if known_pages:
+                        average = known_chars / known_pages
+                        # Only hold back rendering when the whole PDF could pass the limit
+                        if known_chars + (page_count - known_pages) * average < MAX_OCR_CHARS:
+                            break
+                        if known_chars + outstanding * average < MAX_OCR_CHARS:
+                            break
+                    elif outstanding < OCR_WORKERS * batch_size:
+                        # No text to estimate from yet - let the first round run in parallel
+                        break
+                    # Queued pages will likely fill the budget, or a whole round is in
+                    # flight with nothing back yet - see what they hold before rendering more
+                    if batch:
+                        pending.append(_submit_ocr_batch(pool, batch, pages))
+                        batch = []
+                    if not pending:
+                        break
+                    pending.popleft().result()
+
+                if 0 < page_num < page_count - 1 and known_chars >= MAX_OCR_CHARS:
+                    # Pages still waiting in an unsent batch are skipped as well
+                    for item in batch:
+                        pages[item[0]] = ""
+                    skipped += len(batch) + 1
+                    batch = []
+                    pages[page_num] = ""
+                    continue
+
+                page = pdf_document[page_num]
+
+                # First, try extracting native text - born-digital PDFs never need OCR
+                native_text = _native_text(page)
+
+                if len(native_text.strip()) > MIN_NATIVE_CHARS:
+                    # PDF has text layer, use it directly
+                    logger.info("  ✅ Page %d/%d: using native text layer (%d chars)",
+                                page_num + 1, page_count, len(native_text))
+                    pages[page_num] = native_text + "\n"
+                else:
+                    # No text layer, use OCR
+                    logger.info("  🔍 Page %d/%d: no text layer found, queueing OCR...", page_num + 1, page_count)
+
+                    # Convert page to image
+                    zoom = _page_zoom(page)
+                    logger.debug("  🔍 Page %d/%d: rendering at %.2fx zoom", page_num + 1, page_count, zoom)
+                    mat = fitz.Matrix(zoom, zoom)
+                    pix = page.get_pixmap(matrix=mat)
+                    batch.append((page_num, pix.samples, pix.width, pix.height, pix.n))
+                    pix = None  # samples are a copy - let the pixmap go before the next page
+
+                    if len(batch) >= batch_size:
+                        pending.append(_submit_ocr_batch(pool, batch, pages))
+                        batch = []
+
+                        # Don't render further ahead than the pool can keep up with
+                        if len(pending) >= OCR_MAX_PENDING:
+                            pending.popleft().result()
+
+                # Hand over every page that is already done, without waiting on OCR
+                while next_page <= page_num and _page_ready(pages[next_page]):
+                    yield _page_text(pages[next_page])
+                    next_page += 1
+
+            if batch:
+                _submit_ocr_batch(pool, batch, pages)
+
+            if skipped:
+                logger.info("⏭️ Skipped %d interior page(s) once %d characters were extracted",
+                            skipped, known_chars)
+
+        for entry in pages[next_page:]:
+            yield _page_text(entry)
+
+    except BrokenProcessPool:
+        logger.exception("❌ OCR worker died, the pool will be rebuilt on the next request")
+        _discard_ocr_pool(pool)
+        raise
+    except Exception:
+        logger.exception("❌ OCR Error")
         raise
 
 
 # ---------- LLM ----------
-def extract_invoice_json(text):
-    prompt = f"""
-Extract invoice data from this text and return ONLY a valid JSON object.
+# Everything static lives in the system message so the prompt prefix is
+# identical across invoices and can be served from the provider's prompt cache
+SYSTEM_PROMPT = """You are an invoice data extraction expert. Return only valid JSON without markdown formatting. Extract exact values from the text.
+
+Extract invoice data from the invoice text and return ONLY a valid JSON object.
 
 Fields to extract (use null if not found):
 - invoiceNumber: Invoice number (e.g., "0022717122400018")
@@ -112,7 +388,40 @@ Important:
 - Extract ONLY numbers without currency symbols
 - For tax fields, use the actual amount, not rate
 - Return numbers as strings (e.g., "177.66" not 177.66)
+"""
+
+# Cached results from an older prompt are ignored, cached OCR text is still reused
+PROMPT_HASH = hashlib.sha256(SYSTEM_PROMPT.encode("utf-8")).hexdigest()
 
+# Lines likely to carry the header/total fields we extract
+_FIELD_LINE = re.compile(r'invoice|\bpo\b|order|total|tax|gst|vat|amount|discount|₹|\bRs\.?', re.IGNORECASE)
+
+
+def _shortlist(text):
+    """
+    Cut the invoice text down to what the fields need - the first and last lines
+    (supplier, totals) plus any line mentioning invoice/order numbers, taxes or amounts
+    """
+    lines = text.splitlines()
+    keep = set(range(SHORTLIST_EDGE_LINES)) | set(range(len(lines) - SHORTLIST_EDGE_LINES, len(lines)))
+    for i, line in enumerate(lines):
+        if _FIELD_LINE.search(line):
+            # OCR boxes and text blocks usually split "CGST" and "4.23" onto
+            # separate lines - keep the neighbours so the value comes along
+            keep.update((i - 1, i, i + 1))
+    shortlist = "\n".join(line for i, line in enumerate(lines) if i in keep)
+    return shortlist if len(shortlist) >= SHORTLIST_MIN_CHARS else text
+
+
+async def extract_invoice_json(text):
+    text = _shortlist(text)
+    cache_key = hashlib.sha256(text.encode("utf-8")).hexdigest()
+    cached = _llm_cache.get(cache_key)
+    if cached is not None:
+        logger.info("⚡ LLM cache hit, skipping Groq call")
+        return dict(cached)
+
+    prompt = f"""
 Invoice text:
 {text}
 
@@ -120,27 +429,22 @@ Return ONLY the JSON object:
 """
 
     try:
-        response = groq_client.chat.completions.create(
-            model="llama-3.1-8b-instant",
-            messages=[
-                {"role": "system",
-                 "content": "You are an invoice data extraction expert. Return only valid JSON without markdown formatting. Extract exact values from the text."},
-                {"role": "user", "content": prompt}
-            ],
-            temperature=0
-        )
+        # One client per call - its connection pool is bound to the current event loop
+        async with AsyncGroq(api_key=GROQ_API_KEY) as groq_client:
+            response = await groq_client.chat.completions.create(
+                model="llama-3.1-8b-instant",
+                messages=[
+                    {"role": "system", "content": SYSTEM_PROMPT},
+                    {"role": "user", "content": prompt}
+                ],
+                response_format={"type": "json_object"},  # no markdown fences to strip
+                temperature=0
+            )
 
         content = response.choices[0].message.content.strip()
-        print(f"\n🤖 LLM Raw Response:\n{content}\n")
-
-        # Remove markdown code blocks
-        content = re.sub(r'^```(?:json)?\s*', '', content, flags=re.MULTILINE)
-        content = re.sub(r'\s*```$', '', content, flags=re.MULTILINE)
-        content = content.strip().replace('`', '')
-
-        print(f"🧹 Cleaned content:\n{content}\n")
+        logger.debug("🤖 LLM Raw Response:\n%s", content)
 
-        parsed_json = json.loads(content)
+        parsed_json = orjson.loads(content)
 
         # Ensure all expected fields exist
         expected_fields = ["invoiceNumber", "poNumber", "supplierName", "totalAmount",
@@ -149,44 +453,199 @@ Return ONLY the JSON object:
             if field not in parsed_json:
                 parsed_json[field] = None
 
-        print(f"✅ Successfully parsed JSON: {json.dumps(parsed_json, indent=2)}")
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("✅ Successfully parsed JSON: %s", json.dumps(parsed_json, indent=2))
+
+        if len(_llm_cache) >= LLM_CACHE_SIZE:
+            _llm_cache.pop(next(iter(_llm_cache)), None)
+        _llm_cache[cache_key] = dict(parsed_json)
+
         return parsed_json
 
-    except json.JSONDecodeError as e:
-        print(f"❌ JSON Parse Error: {e}")
-        print(f"Raw content that failed: {content}")
+    except json.JSONDecodeError as e:  # also catches orjson.JSONDecodeError
+        logger.error("❌ JSON Parse Error: %s\nRaw content that failed: %s", e, content)
         raise ValueError(f"Failed to parse JSON from LLM response: {e}")
-    except Exception as e:
-        print(f"❌ LLM Error: {e}")
-        import traceback
-        traceback.print_exc()
+    except Exception:
+        logger.exception("❌ LLM Error")
         raise
 
 
-# ---------- PIPELINE ----------
-def process_invoice(pdf_path):
-    print(f"\n{'=' * 60}")
-    print(f"📄 Starting processing: {pdf_path}")
-    print(f"{'=' * 60}\n")
+# ---------- CACHE ----------
+# Everything that changes which text a PDF yields - cached text from other settings is stale
+OCR_SETTINGS_HASH = hashlib.sha256(repr((
+    MIN_NATIVE_CHARS, OCR_MAX_ZOOM, OCR_TARGET_SIDE, MAX_OCR_CHARS, OCR_TEXTLINE_ORIENTATION,
+)).encode("utf-8")).hexdigest()
+
+
+def _file_hash(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(UPLOAD_CHUNK_SIZE), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _init_cache_db():
+    with closing(sqlite3.connect(CACHE_DB, timeout=10)) as conn, conn:
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS invoice_cache (
+                file_hash TEXT PRIMARY KEY,
+                text TEXT NOT NULL,
+                ocr_hash TEXT NOT NULL,
+                data BLOB,
+                prompt_hash TEXT
+            )
+        """)
+
+
+_init_cache_db()
+
 
-    text = extract_text_from_pdf(pdf_path)
+def _cache_connect():
+    return sqlite3.connect(CACHE_DB, timeout=10)
+
+
+def _cache_get(file_hash):
+    """
+    (OCR text, invoice JSON) cached for this file, either may be None.
+    Nothing counts if the text came from different OCR settings, and the JSON
+    only counts if it was produced with the current prompt.
+    """
+    with closing(_cache_connect()) as conn:
+        row = conn.execute("SELECT text, ocr_hash, data, prompt_hash FROM invoice_cache WHERE file_hash = ?",
+                           (file_hash,)).fetchone()
+    if row is None:
+        return None, None
+    text, ocr_hash, data, prompt_hash = row
+    if ocr_hash != OCR_SETTINGS_HASH:
+        return None, None
+    if data is None or prompt_hash != PROMPT_HASH:
+        return text, None
+    return text, orjson.loads(data)
+
+
+def _cache_put(file_hash, text, invoice_json=None):
+    data = orjson.dumps(invoice_json) if invoice_json is not None else None
+    with closing(_cache_connect()) as conn, conn:
+        conn.execute("INSERT OR REPLACE INTO invoice_cache (file_hash, text, ocr_hash, data, prompt_hash) "
+                     "VALUES (?, ?, ?, ?, ?)",
+                     (file_hash, text, OCR_SETTINGS_HASH, data, PROMPT_HASH))
+        # REPLACE gives the row a new rowid, so the lowest rowids are the least recently written
+        conn.execute("DELETE FROM invoice_cache WHERE rowid NOT IN "
+                     "(SELECT rowid FROM invoice_cache ORDER BY rowid DESC LIMIT ?)",
+                     (CACHE_MAX_ROWS,))
+
+
+# ---------- PIPELINE ----------
+async def _process_invoice_async(pdf_path, file_hash, cached_text=None):
+    """
+    Drain the OCR pages and, when there is enough text but the next page is still
+    stuck in OCR, start the LLM call early. It is only called again if the later
+    pages add lines with invoice fields (numbers, totals, taxes).
+    With cached_text (same file seen before), OCR is skipped entirely.
+    """
+    speculative = None
+    speculative_pages = 0  # pages the early LLM call saw
+
+    if cached_text is not None:
+        logger.info("⚡ OCR cache hit, skipping OCR")
+        text = cached_text
+    else:
+        pages = extract_text_from_pdf(pdf_path)
+        parts = []
+        text_length = 0
+
+        while True:
+            # Pull pages in a thread so the speculative LLM call can run meanwhile
+            next_page = asyncio.ensure_future(asyncio.to_thread(next, pages, None))
+
+            if speculative is None and text_length >= SPECULATIVE_MIN_CHARS:
+                # Only worth it if the next page is actually waiting on OCR - pages
+                # that arrive right away would just make us call the LLM twice
+                done, _ = await asyncio.wait({next_page}, timeout=SPECULATIVE_WAIT)
+                if not done:
+                    speculative_text = "".join(parts).strip()
+                    speculative_pages = len(parts)
+                    logger.info("🤖 %d characters ready, starting LLM extraction while OCR continues...",
+                                len(speculative_text))
+                    speculative = asyncio.create_task(extract_invoice_json(speculative_text))
+
+            page_text = await next_page
+            if page_text is None:
+                break
+            parts.append(page_text)
+            text_length += len(page_text)
+
+        text = "".join(parts).strip()
+        _cache_put(file_hash, text)
+
+    logger.info("✅ Total extracted text length: %d characters", len(text))
+    logger.debug("📄 First 500 chars:\n%s", text[:500])
 
     if not text or len(text) < 10:
         raise ValueError(f"Insufficient text extracted from OCR. Got only {len(text)} characters.")
 
-    print(f"\n{'=' * 60}")
-    print(f"🤖 Sending to LLM for extraction...")
-    print(f"{'=' * 60}\n")
+    invoice_json = None
+    if speculative is not None:
+        later_text = "".join(parts[speculative_pages:])
+        if not _FIELD_LINE.search(later_text):
+            logger.info("⚡ Later pages added no invoice fields, using early LLM extraction")
+            invoice_json = await speculative
+        else:
+            logger.info("🔁 Later pages added invoice fields, discarding early LLM extraction")
+            speculative.cancel()
+            await asyncio.gather(speculative, return_exceptions=True)
+
+    if invoice_json is None:
+        logger.info("🤖 Sending to LLM for extraction...")
+        invoice_json = await extract_invoice_json(text)
+
+    _cache_put(file_hash, text, invoice_json)
+    return invoice_json
+
+
+def process_invoice(pdf_path):
+    logger.info("📄 Starting processing: %s", pdf_path)
 
-    invoice_json = extract_invoice_json(text)
+    # Identical uploads collapse to a hash + lookup
+    file_hash = _file_hash(pdf_path)
+    cached_text, cached_json = _cache_get(file_hash)
+    if cached_json is not None:
+        logger.info("⚡ Result cache hit for %s, skipping OCR and LLM", pdf_path)
+        return cached_json
 
-    print(f"\n{'=' * 60}")
-    print(f"✅ Processing complete!")
-    print(f"{'=' * 60}\n")
+    invoice_json = asyncio.run(_process_invoice_async(pdf_path, file_hash, cached_text))
+
+    logger.info("✅ Processing complete: %s", pdf_path)
 
     return invoice_json
 
 
+# ---------- UPLOAD ----------
+def _stream_upload_to(path):
+    """
+    Write the multipart "file" field straight to path in UPLOAD_CHUNK_SIZE chunks,
+    without Flask buffering the body. Returns the client's filename, or None if
+    the field was missing.
+    """
+    target = FileTarget(path)
+    parser = StreamingFormDataParser(headers={"Content-Type": request.content_type})
+    parser.register("file", target)
+
+    while True:
+        chunk = request.stream.read(UPLOAD_CHUNK_SIZE)
+        if not chunk:
+            break
+        parser.data_received(chunk)
+
+    return target.multipart_filename
+
+
+def _discard(path):
+    if os.path.exists(path):
+        os.remove(path)
+
+
 # ---------- ROUTES ----------
 @app.route("/")
 def index():
@@ -196,33 +655,53 @@ def index():
 @app.route("/upload", methods=["POST"])
 def upload():
     try:
-        if "file" not in request.files:
+        if request.mimetype != "multipart/form-data":
             return jsonify({"error": "No file uploaded"}), 400
 
-        file = request.files["file"]
+        # Stream to a temporary name first - the real filename is only known once parsed
+        tmp_path = os.path.join(app.config["UPLOAD_FOLDER"], f".upload-{uuid.uuid4().hex}")
+        try:
+            client_filename = _stream_upload_to(tmp_path)
+        except Exception:
+            _discard(tmp_path)
+            raise
 
-        if file.filename == "":
+        if client_filename is None:
+            _discard(tmp_path)
+            return jsonify({"error": "No file uploaded"}), 400
+
+        if client_filename == "":
+            _discard(tmp_path)
             return jsonify({"error": "No file selected"}), 400
 
-        if not file.filename.lower().endswith('.pdf'):
+        if not client_filename.lower().endswith('.pdf'):
+            _discard(tmp_path)
             return jsonify({"error": "Only PDF files are supported"}), 400
 
-        filename = secure_filename(file.filename)
+        filename = secure_filename(client_filename)
         path = os.path.join(app.config["UPLOAD_FOLDER"], filename)
-        file.save(path)
-
-        print(f"✅ File saved: {path}")
 
-        data = process_invoice(path)
+        # Hash and OCR the uniquely named temp file - concurrent uploads with the
+        # same filename would otherwise overwrite each other mid-processing and
+        # cache one file's text under the other's hash
+        try:
+            data = process_invoice(tmp_path)
+        finally:
+            os.replace(tmp_path, path)
+            logger.info("✅ File saved: %s", path)
 
-        return jsonify({"success": True, "data": data})
+        return app.response_class(orjson.dumps({"success": True, "data": data}),
+                                  mimetype="application/json")
 
+    except RequestEntityTooLarge:
+        return jsonify({"error": f"File too large (max {MAX_UPLOAD_BYTES // (1024 * 1024)} MB)"}), 413
     except Exception as e:
-        print(f"\n❌ ERROR: {str(e)}\n")
-        import traceback
-        traceback.print_exc()
+        logger.exception("❌ ERROR: %s", e)
         return jsonify({"success": False, "error": str(e)}), 500
 
 
 if __name__ == "__main__":
+    # The debug reloader runs this twice; only warm up in the process that serves
+    if os.environ.get("WERKZEUG_RUN_MAIN") == "true":
+        warm_ocr_pool()
     app.run(debug=True, port=5000)
\ No newline at end of file